@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 """
 Dirwatcher exercise
 Demonstrate long-running applications by monitoring text files in a directory
@@ -9,60 +9,351 @@ and the text for which to scan('magic text').
 """
 import time
 import os
+import re
+import select
 import argparse
 import logging
 from datetime import datetime as dt
 import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    # inotify_simple is optional, without it we fall back to polling
+    INotify = None
 
 __author__ = 'jontaylor224'
 
 
-exit_flag = False
+stop_event = threading.Event()
 logger = logging.getLogger(__name__)
 
-# keys are filenames, values are last line read
+# worker threads used to scan watched files
+executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+
+# buffer size for reading watched files
+READ_BUFFER_SIZE = 1 << 16
+
+# most bytes of a file held in memory at once while scanning it
+SCAN_CHUNK_SIZE = 1 << 20
+
+# most line numbers reported in a single log record
+MAX_LINES_PER_RECORD = 100
+
+# mtime of the watched directory when it was last listed, and when that was.
+# 0 means the listing can't be trusted (eg. a new file failed to open) and
+# the directory must be listed again
+last_dir_mtime = 0
+last_dir_listed = 0
+
+# a listing taken this soon after the directory mtime may have missed a
+# change made within the same mtime tick, so don't trust it (like git's
+# racy timestamp check)
+RACY_MTIME_WINDOW_NS = 2 * 10 ** 9
+
+# keys are filenames, values are dicts holding the full 'path', the open
+# file 'fp' and the byte 'offset' and 'line' number scanned up to
 watched_files = {}
 
-signames = dict((k, v) for v, k in reversed(sorted(signal.__dict__.items()))
-                if v.startswith('SIG') and not v.startswith('SIG_'))
 
+def open_watched_file(filename):
+    '''Returns a new watched_files entry for filename, opened at the top'''
+    return {'path': filename,
+            'fp': open(filename, 'rb', buffering=READ_BUFFER_SIZE),
+            'offset': 0, 'line': 0}
+
+
+def close_watched_file(watched):
+    '''Closes the file held open by a watched_files entry'''
+    watched['fp'].close()
+
+
+def scan_single_file(watched, magic):
+    '''Scan the open file in watched for magic, carrying on from where the
+    last scan stopped. Updates the watched_files entry in place'''
+    filename = watched['path']
+    fp = watched['fp']
+    file_stat = os.fstat(fp.fileno())
+    if os.stat(filename).st_ino != file_stat.st_ino:
+        # File was replaced (eg. log rotation), follow the new one. Only
+        # let go of the old file once the new one has opened, and update the
+        # entry in place, so watched_files always holds a usable entry even
+        # if the reopen or the rest of this scan fails.
+        logger.info('File=%s replaced, reopening', filename)
+        new_watched = open_watched_file(filename)
+        close_watched_file(watched)
+        watched.update(new_watched)
+        fp = watched['fp']
+    elif file_stat.st_size < watched['offset']:
+        # File was truncated, start over from the top
+        logger.info('File=%s truncated, rescanning', filename)
+        fp.seek(0)
+        watched['offset'], watched['line'] = 0, 0
 
-def scan_single_file(filename, start_line, magic):
-    '''Scan file for magic, starting at start_line'''
-    line_num = 0
-    with open(filename) as f:
-        for line_num, line in enumerate(f):
-            if line_num >= start_line:
-                if magic in line:
-                    logger.info('File={}: found text={} on line={}'
-                                .format(filename, magic, line_num + 1))
-    return line_num + 1
+    # Read the tail a bounded chunk at a time, carrying a partial last line
+    # over into the next chunk, so a large tail is never held in memory at
+    # once. (The file isn't mmapped: if it were truncated while mapped, eg.
+    # by copytruncate rotation, touching the lost pages would raise SIGBUS.)
+    tail = b''
+    try:
+        while True:
+            chunk = fp.read(SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            buf = tail + chunk
+            end = buf.rfind(b'\n') + 1
+            tail = buf[end:]
+            watched['line'] = scan_buffer(filename, buf, end,
+                                          watched['line'], magic)
+            watched['offset'] += end
+    except Exception:
+        # Rewind to what was actually scanned, so the next scan retries it
+        fp.seek(watched['offset'])
+        raise
+    if tail:
+        # Leave the partial last line for the next scan
+        fp.seek(watched['offset'])
+
+
+def scan_buffer(filename, buf, end, line_num, magic):
+    '''Log the lines in buf[:end] matching the magic regex, where buf starts
+    at the beginning of line line_num + 1. Returns the line number reached'''
+    pos = 0
+    # keys are the matched texts, values are the lines they were found on
+    hits = {}
+    # Each match runs to the end of its line, so a line is only reported once
+    for match in magic.finditer(buf, 0, end):
+        if match.start() < pos or match.start() == end:
+            # An empty magic also matches at the end of the line just found,
+            # and at end where no complete line starts
+            continue
+        line_num += buf.count(b'\n', pos, match.start()) + 1
+        hits.setdefault(match.group(1), []).append(line_num)
+        pos = match.end() + 1
+    # Log the lines found for a text a batch at a time rather than a record
+    # per line, without letting one record grow unbounded
+    for text, lines in hits.items():
+        text = text.decode('utf-8', 'replace')
+        for i in range(0, len(lines), MAX_LINES_PER_RECORD):
+            logger.info('File=%s: found text=%s on line=%s', filename, text,
+                        LineNumbers(lines[i:i + MAX_LINES_PER_RECORD]))
+    return line_num + buf.count(b'\n', pos, end)
+
+
+class LineNumbers(object):
+    '''Line numbers for a log record, only joined up if it is emitted'''
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __str__(self):
+        return ','.join(map(str, self.lines))
+
+
+def compile_magic(*texts):
+    '''Returns a bytes regex matching any of texts along with the rest of
+    the line it is on, so each line can be searched in a single pass'''
+    needles = b'|'.join(re.escape(text.encode('utf-8')) for text in texts)
+    return re.compile(b'(' + needles + b')[^\n]*')
 
 
 def watch_directory(path, ext, magic):
     '''Monitors the path directory for files with extension type ext
     containing magic text'''
-    dir_files = os.listdir(path)
+    # Files can only have been added or removed if the directory changed
+    global last_dir_mtime, last_dir_listed
+    dir_mtime = os.stat(path).st_mtime_ns
+    if (dir_mtime != last_dir_mtime
+            or last_dir_listed - dir_mtime < RACY_MTIME_WINDOW_NS):
+        listed = time.time_ns()
+        with os.scandir(path) as entries:
+            dir_files = {entry.name for entry in entries
+                         if entry.name.endswith(ext)
+                         and entry.is_file(follow_symlinks=False)}
+
+        # Check for new files
+        opened_all = True
+        for file in dir_files - watched_files.keys():
+            try:
+                watched_files[file] = open_watched_file(
+                    os.path.join(path, file))
+            except OSError as e:
+                logger.error("ERROR: %s", e)
+                opened_all = False
+                continue
+            logger.info('Watching new file=%s', file)
 
-    # Check for new files
-    for file in dir_files:
-        if file.endswith(ext):
-            if file not in watched_files:
-                logger.info('Watching new file={}'.format(file))
-                watched_files[file] = 1
+        # Stop watching deleted files
+        for file in watched_files.keys() - dir_files:
+            logger.info('Removed file=%s', file)
+            close_watched_file(watched_files.pop(file))
 
-    # Stop watching deleted files
-    for file in watched_files.keys():
-        if file not in dir_files:
-            logger.info('Removed file={}'.format(file))
-            watched_files.pop(file)
+        if opened_all:
+            last_dir_mtime, last_dir_listed = dir_mtime, listed
+        else:
+            # Retry the files that failed to open on the next tick
+            last_dir_mtime = 0
 
-    # Scan watched files
-    for f in watched_files:
-        file_path = os.path.join(path, f)
-        start_line = watched_files[f]
-        watched_files[f] = scan_single_file(file_path, start_line, magic)
+    scan_files(watched_files, magic)
+
+
+def scan_files(files, magic):
+    '''Scans the named watched files in parallel, they are independent of
+    each other'''
+    tasks = [(f, executor.submit(scan_single_file, watched_files[f], magic))
+             for f in files]
+    for f, task in tasks:
+        try:
+            task.result()
+        except OSError as e:
+            logger.error("ERROR: %s", e)
+        except Exception as e:
+            logger.error("UNHANDLED EXCEPTION: File=%s: %s", f, e)
+
+
+def handle_events(path, ext, events, magic):
+    '''Updates watched_files from a batch of inotify events on the path
+    directory, then scans the watched files that changed'''
+    global last_dir_mtime
+    changed = set()
+    # Entries for files renamed away, by cookie, until we see where they went
+    moved = {}
+    try:
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                # The kernel dropped events, so reconcile the whole directory
+                logger.warning('Event queue overflowed, rescanning dir=%s',
+                               path)
+                watch_directory(path, ext, magic)
+                return
+            file = event.name
+            if event.mask & flags.ISDIR or not file.endswith(ext):
+                continue
+            file_path = os.path.join(path, file)
+
+            if event.mask & flags.MOVED_FROM and file in watched_files:
+                moved[event.cookie] = watched_files.pop(file)
+                changed.discard(file)
+            elif event.mask & flags.DELETE:
+                watched = watched_files.pop(file, None)
+                if watched is not None:
+                    logger.info('Removed file=%s', file)
+                    close_watched_file(watched)
+                changed.discard(file)
+            elif event.mask & flags.MOVED_TO and event.cookie in moved:
+                # Renamed within the directory, carry on from where it was
+                logger.info('Watching renamed file=%s', file)
+                replaced = watched_files.pop(file, None)
+                if replaced is not None:
+                    # Renamed over a file we were already watching
+                    close_watched_file(replaced)
+                watched = moved.pop(event.cookie)
+                watched['path'] = file_path
+                watched_files[file] = watched
+                changed.add(file)
+            elif event.mask & (flags.CREATE | flags.MOVED_TO):
+                if file in watched_files:
+                    # Replaced in place (eg. an atomic rename over it), the
+                    # scan notices the new inode and reopens it
+                    changed.add(file)
+                    continue
+                if os.path.islink(file_path) or not os.path.isfile(file_path):
+                    continue
+                try:
+                    watched_files[file] = open_watched_file(file_path)
+                except OSError as e:
+                    logger.error("ERROR: %s", e)
+                    # No further event may come for it, so have watch_events
+                    # retry it with a full listing
+                    last_dir_mtime = 0
+                    continue
+                logger.info('Watching new file=%s', file)
+                changed.add(file)
+            elif file in watched_files:
+                changed.add(file)
+    finally:
+        # Anything renamed out of the directory is no longer watched. This
+        # also runs if the batch fails part way, so their files aren't leaked
+        for watched in moved.values():
+            logger.info('Removed file=%s', os.path.basename(watched['path']))
+            close_watched_file(watched)
+
+    scan_files(changed, magic)
+
+
+def start_inotify(path):
+    '''Returns an INotify with a single watch on the path directory, or None
+    if event-driven watching is unavailable and we must poll instead'''
+    if INotify is None:
+        logger.warning('inotify_simple not installed, polling dir=%s', path)
+        return None
+    try:
+        inotify = INotify()
+    except OSError as e:
+        logger.warning('Unable to watch dir=%s for events, polling: %s',
+                       path, e)
+        return None
+    # One watch on the directory covers every file in it. Leave out
+    # IN_OPEN/IN_ACCESS so our own reads don't wake us up again.
+    try:
+        inotify.add_watch(path, flags.CREATE | flags.DELETE | flags.MODIFY
+                          | flags.MOVED_TO | flags.MOVED_FROM)
+    except OSError as e:
+        logger.warning('Unable to watch dir=%s for events, polling: %s',
+                       path, e)
+        inotify.close()
+        return None
+    return inotify
+
+
+def watch_events(inotify, path, ext, magic, interval):
+    '''Handles inotify events on the path directory until stopped, or until
+    the directory watch is lost and we must fall back to polling. While a
+    new file is failing to open, the directory is relisted every interval
+    seconds to retry it'''
+    # A trapped signal writes to wake_w, so the poll returns straight away
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    old_wakeup_fd = signal.set_wakeup_fd(wake_w)
+    poller = select.poll()
+    poller.register(inotify.fileno(), select.POLLIN)
+    poller.register(wake_r, select.POLLIN)
+    try:
+        while not stop_event.is_set():
+            timeout = None if last_dir_mtime else interval * 1000
+            ready = poller.poll(timeout)
+            for fd, _ in ready:
+                if fd == wake_r:
+                    os.read(wake_r, 512)
+            events = inotify.read(timeout=0)
+            if any(event.mask & flags.IGNORED for event in events):
+                logger.warning('Lost watch on dir=%s, polling', path)
+                return
+            try:
+                if events:
+                    handle_events(path, ext, events, magic)
+                elif not ready:
+                    watch_directory(path, ext, magic)
+            except OSError as e:
+                logger.error("ERROR: %s", e)
+            except Exception as e:
+                logger.error("UNHANDLED EXCEPTION: %s", e)
+                if stop_event.wait(4):
+                    break
+                # The rest of the failed batch was lost, so catch up with a
+                # full reconcile like the polling loop would on its next tick
+                try:
+                    watch_directory(path, ext, magic)
+                except Exception as e:
+                    logger.error("UNHANDLED EXCEPTION: %s", e)
+    finally:
+        signal.set_wakeup_fd(old_wakeup_fd)
+        os.close(wake_r)
+        os.close(wake_w)
+        inotify.close()
 
 
 def create_parser():
@@ -73,7 +364,9 @@ def create_parser():
     parser.add_argument('-e', '--ext', type=str, default='.txt',
                         help='Text file extension to monitor. eg. .txt, .log')
     parser.add_argument('-i', '--int', type=float, default=1.0,
-                        help='Number of seconds of polling interval.')
+                        help='Number of seconds of polling interval. With '
+                        'inotify, only used to retry files that failed to '
+                        'open.')
     parser.add_argument('path', help='Directory to monitor.')
     parser.add_argument(
         'magic', help='Text string the program is seeking.')
@@ -83,16 +376,14 @@ def create_parser():
 def signal_handler(sig_num, frame):
     """
    Handler for SIGTERM and SIGINT.
-   Sets a global flag which will cause main() to exit its loop if either
-   signal is trapped.
+   Sets a global event which will wake main() and cause it to exit its
+   loop if either signal is trapped.
    :param sig_num: The integer signal number that was trapped from the OS.
    :param frame: Not used
    :return None
    """
-    # log the signal name (the python2 way)
-    logger.warn('Received OS Signal ' + signames[sig_num])
-    global exit_flag
-    exit_flag = True
+    logger.warning('Received OS Signal %s', signal.Signals(sig_num).name)
+    stop_event.set()
 
 
 def main():
@@ -126,19 +417,42 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
 
     logger.info(
-        'Watching dir={} for files with extension={} containing text={}'
-        .format(args.path, args.ext, args.magic))
-    while not exit_flag:
+        'Watching dir=%s for files with extension=%s containing text=%s',
+        args.path, args.ext, args.magic)
+
+    # Files are searched as raw bytes, so build the magic regex just once
+    magic = compile_magic(args.magic)
+
+    # Start watching before picking up the files already in the directory,
+    # so a file created in between still gets an event
+    inotify = start_inotify(args.path)
+    try:
+        watch_directory(args.path, args.ext, magic)
+    except OSError as e:
+        logger.error("ERROR: %s", e)
+    if inotify is not None:
+        try:
+            watch_events(inotify, args.path, args.ext, magic, args.int)
+        except Exception as e:
+            logger.error("UNHANDLED EXCEPTION: %s, polling dir=%s",
+                         e, args.path)
+
+    while not stop_event.is_set():
         try:
             # logger.debug('looping...')
-            watch_directory(args.path, args.ext, args.magic)
+            watch_directory(args.path, args.ext, magic)
         except OSError as e:
-            logger.error("ERROR: {}".format(e))
+            logger.error("ERROR: %s", e)
         except Exception as e:
-            logger.error("UNHANDLED EXCEPTION: {}".format(e))
-            time.sleep(4)
+            logger.error("UNHANDLED EXCEPTION: %s", e)
+            if stop_event.wait(4):
+                break
+
+        stop_event.wait(args.int)
 
-        time.sleep(args.int)
+    executor.shutdown()
+    for watched in watched_files.values():
+        close_watched_file(watched)
 
     # Setup Shutdown Banner
     uptime = dt.now() - app_start_time